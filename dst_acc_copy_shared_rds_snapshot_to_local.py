@@ -5,9 +5,13 @@ import logging
 import os
 import re
 import sys
-import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from operator import itemgetter
 
 import boto3
+from botocore.config import Config
+from botocore.exceptions import WaiterError
 
 if "AWS_DEFAULT_REGION" not in os.environ:
     print("Please set the environment variable AWS_DEFAULT_REGION")
@@ -19,59 +23,101 @@ from snapshots_tool_utils import *
 LOGLEVEL = os.getenv('LOG_LEVEL', 'DEBUG').strip()
 BACKUP_INTERVAL = int(os.getenv('INTERVAL', '24'))
 EXPECTED_SNAPSHOT_COUNT = int(os.getenv('EXPECTED_SNAPSHOT_COUNT', 4))
+MAX_WORKERS = int(os.getenv('MAX_WORKERS', 16))
+# poll snapshot status every WAIT_DELAY seconds, give up after WAIT_MAX_ATTEMPTS polls,
+# defaults allow up to 12 hours for large cross-KMS copies
+WAIT_DELAY = int(os.getenv('WAIT_DELAY', 15))
+WAIT_MAX_ATTEMPTS = int(os.getenv('WAIT_MAX_ATTEMPTS', 2880))
 # for prod RDS matching (every DB expect QA), must be set to
 # export PATTERN='^((?!qa).)*$'
 # or ((.+)prod.(.+)|speech-api$) - everything with prod in name plus speech-api
 PATTERN = os.getenv('PATTERN', 'ALL_INSTANCES')
 TAGGEDINSTANCE = os.getenv('TAGGEDINSTANCE', 'FALSE')
-shared_snapshot_regex = r"arn:aws:rds:(.+):\d{12}:snapshot:"
+SHARED_SNAPSHOT_RE = re.compile(r"arn:aws:rds:(.+):\d{12}:snapshot:")
+KMS_KEY_RE = re.compile(r"^arn:aws:kms:(.+):\d{12}:(?:key\/[a-f0-9-]+)$")
 
 TIMESTAMP_FORMAT = '%Y-%m-%d-%H-%M'
 
-logger = logging.getLogger()
+# log to stdout alongside the print() output, the root logger is left alone so
+# botocore/urllib3 debug records (request headers, credentials) are never emitted
+logger = logging.getLogger(__name__)
 logger.setLevel(LOGLEVEL.upper())
-
-sns_client = boto3.client('sns')
+logger.propagate = False
+_log_handler = logging.StreamHandler(sys.stdout)
+_log_handler.setFormatter(logging.Formatter('%(message)s'))
+logger.addHandler(_log_handler)
+
+# one session for all clients, so service models and credentials are loaded only once
+session = boto3.session.Session(region_name=os.getenv('AWS_DEFAULT_REGION'))
+sns_client = session.client('sns')
 topic_arn = os.environ.get("TOPIC_ARN", "")
 
 
 def main():
 
-    aws_region = os.getenv('AWS_DEFAULT_REGION')
-    client = boto3.client('rds', region_name=aws_region)
+    # low-level clients are thread safe, the worker threads share this one,
+    # so size its connection pool to the number of workers
+    client = session.client('rds', config=Config(max_pool_connections=MAX_WORKERS))
 
     # lookup KMS key ARN in env vars, it must be created in backup account and shared with main account
     kms_key_arn = os.getenv('KMS_KEY_ARN', '')
-    if not bool(re.match(r"^arn:aws:kms:(.+):\d{12}:(?:key\/[a-f0-9-]+)$", kms_key_arn)):
+    if not bool(KMS_KEY_RE.match(kms_key_arn)):
         print("KMS_KEY_ARN environment variable must be set to KMS key AWS arn, like arn:aws:kms:<region>:<account_id>:key/<key_id>")
         sys.exit(1)
 
-    response = client.describe_db_snapshots(IncludeShared=True)
+    # only snapshots shared with this account are copied, skip own automated and manual ones
+    response = paginate_api_call(client, 'describe_db_snapshots', 'DBSnapshots',
+                                 SnapshotType='shared', IncludeShared=True)
     if not response.get('DBSnapshots'):
         print("Unable to find snapshots, shared with current account, exiting")
         sys.exit(1)
     snapshots_with_shared = response['DBSnapshots']
-    snapshots_owned = {}
+    snapshots_owned = Counter()
     ready_snapshot_count = 0
+    recrypted_shared_snapshots = []
     for snapshot in snapshots_with_shared:
-        if not bool(re.search(r"recrypted$", snapshot['DBSnapshotIdentifier'])) or \
-           not bool(re.search(shared_snapshot_regex, snapshot['DBSnapshotIdentifier'])):
+        snapshot_id = snapshot['DBSnapshotIdentifier']
+        # cheap string checks first, most snapshots are rejected before the regex
+        if not snapshot_id.endswith("recrypted"):
             continue
-        local_copy = copy_shared_snapshot_to_local(client, snapshot, kms_key_arn)
-        wait_for_snapshot_to_be_ready(client, local_copy)
-        ready_snapshot_count += 1
-        # count owned snapshots count for db instance
-        snapshots_owned[snapshot['DBInstanceIdentifier']] = snapshots_owned.get(snapshot['DBInstanceIdentifier'], 0) + 1
-
+        if not snapshot_id.startswith("arn:aws:rds:"):
+            continue
+        if not bool(SHARED_SNAPSHOT_RE.match(snapshot_id)):
+            continue
+        recrypted_shared_snapshots.append(snapshot)
+    if len(recrypted_shared_snapshots) > 0:
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(recrypted_shared_snapshots))) as executor:
+            futures = {executor.submit(process_shared_snapshot, client, snapshot, kms_key_arn): snapshot
+                       for snapshot in recrypted_shared_snapshots}
+            for future in as_completed(futures):
+                # a failed snapshot is not counted, so the count check below reports it
+                try:
+                    snapshot = future.result()
+                except Exception:
+                    logger.exception("Copying shared snapshot %s failed", futures[future]['DBSnapshotIdentifier'])
+                    continue
+                if snapshot is None:
+                    continue
+                ready_snapshot_count += 1
+                # count owned snapshots count for db instance
+                snapshots_owned[snapshot['DBInstanceIdentifier']] += 1
+
+    excess_snapshots = []
     for db_instance in snapshots_owned.keys():
-        while get_owned_rds_snapshots_count(client, db_instance) > 2:
-            snapshot = get_oldest_manual_recrypted_rds_snapshots(client, db_instance)
-            print("Deleting oldest recrypted manual snapshot {}".format(snapshot['DBSnapshotIdentifier']))
-            client.delete_db_snapshot(DBSnapshotIdentifier=snapshot['DBSnapshotIdentifier'])
-            time.sleep(1)
+        # keep the two newest snapshots, the list is sorted oldest first
+        excess_snapshots.extend(get_owned_rds_snapshots(client, db_instance)[:-2])
+    if len(excess_snapshots) > 0:
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(excess_snapshots))) as executor:
+            futures = {executor.submit(delete_snapshot, client, snapshot): snapshot
+                       for snapshot in excess_snapshots}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception:
+                    logger.exception("Deleting snapshot %s failed", futures[future]['DBSnapshotIdentifier'])
     if ready_snapshot_count != EXPECTED_SNAPSHOT_COUNT:
         sns_message = ("COPY_RDS_SNAPSHOT_COUNT_ERROR Shared RDS snapshot copying completed with error:\n"
-                       "Expected snapshot count={1} not equal to actual snapshot count={2}, exiting"
+                       "Expected snapshot count={0} not equal to actual snapshot count={1}, exiting"
                        .format(EXPECTED_SNAPSHOT_COUNT, ready_snapshot_count))
         print(sns_message)
         if not debug and topic_arn:
@@ -82,33 +128,42 @@ def main():
     return
 
 
+def process_shared_snapshot(rds_client, shared_snapshot, kms_key_arn):
+    # copy a single shared snapshot to local account and wait for it,
+    # returns the shared snapshot or None if the copy did not become available
+    local_copy = copy_shared_snapshot_to_local(rds_client, shared_snapshot, kms_key_arn)
+    try:
+        wait_for_snapshot_to_be_ready(rds_client, local_copy)
+    except WaiterError as e:
+        logger.error("Snapshot %s did not become available: %s", local_copy['DBSnapshotIdentifier'], e)
+        return None
+    return shared_snapshot
+
+
+def delete_snapshot(rds_client, snapshot):
+    logger.info("Deleting oldest recrypted manual snapshot %s", snapshot['DBSnapshotIdentifier'])
+    rds_client.delete_db_snapshot(DBSnapshotIdentifier=snapshot['DBSnapshotIdentifier'])
+
+
 def wait_for_snapshot_to_be_ready(rds_client, snapshot):
-    percent_progress = -1
-    # simply check if the specified snapshot is healthy every 10 seconds until it is available
-    while True:
-        snapshotcheck = rds_client.describe_db_snapshots(
-            DBSnapshotIdentifier=snapshot['DBSnapshotIdentifier'])['DBSnapshots'][0]
-        if snapshotcheck['Status'] == 'available':
-            print("  Snapshot {} complete and available!".format(snapshot['DBSnapshotIdentifier']))
-            break
-        else:
-            # output percentage only when it's changed
-            if percent_progress != snapshotcheck['PercentProgress']:
-                percent_progress = snapshotcheck['PercentProgress']
-                print("Snapshot {} in progress, {}% complete".format(
-                    snapshot['DBSnapshotIdentifier'], snapshotcheck['PercentProgress']))
-            time.sleep(10)
+    # let the boto3 waiter poll the specified snapshot until it is available
+    logger.info("Waiting for snapshot %s to become available...", snapshot['DBSnapshotIdentifier'])
+    waiter = rds_client.get_waiter('db_snapshot_available')
+    waiter.wait(
+        DBSnapshotIdentifier=snapshot['DBSnapshotIdentifier'],
+        WaiterConfig={'Delay': WAIT_DELAY, 'MaxAttempts': WAIT_MAX_ATTEMPTS}
+    )
+    logger.info("  Snapshot %s complete and available!", snapshot['DBSnapshotIdentifier'])
 
 
 def copy_shared_snapshot_to_local(rds_client, shared_snapshot, kms_key_arn):
     # unfortunately it's not possible to restore an RDS instance directly from a
     # snapshot that is shared by another account. This makes a copy local to the
     # account where we want to restore the RDS instance
-    target_db_snapshot_id = re.sub(shared_snapshot_regex, "", shared_snapshot['DBSnapshotIdentifier'])
-    target_db_snapshot_id = "{}-copy".format(target_db_snapshot_id)
+    target_db_snapshot_id = SHARED_SNAPSHOT_RE.sub("", shared_snapshot['DBSnapshotIdentifier']) + "-copy"
 
-    print("Copying shared snaphot {} to local snapshot {}...".format(
-        shared_snapshot['DBSnapshotArn'], target_db_snapshot_id))
+    logger.info("Copying shared snaphot %s to local snapshot %s...",
+                shared_snapshot['DBSnapshotArn'], target_db_snapshot_id)
 
     try:
         copy = rds_client.copy_db_snapshot(
@@ -116,58 +171,36 @@ def copy_shared_snapshot_to_local(rds_client, shared_snapshot, kms_key_arn):
             TargetDBSnapshotIdentifier=target_db_snapshot_id,
             KmsKeyId=kms_key_arn
         )
-        print("  Copy created.")
+        logger.info("  Copy %s created.", target_db_snapshot_id)
         return copy['DBSnapshot']
     except rds_client.exceptions.DBSnapshotAlreadyExistsFault:
         # if the snapshot we tried to make already exists, retrieve it
-        print("Snapshot already exists, retrieving {}...".format(target_db_snapshot_id))
+        logger.info("Snapshot already exists, retrieving %s...", target_db_snapshot_id)
 
         snapshots = rds_client.describe_db_snapshots(
             DBSnapshotIdentifier=target_db_snapshot_id,
         )
-        print("  Retrieved.")
+        logger.info("  Retrieved %s.", target_db_snapshot_id)
         return snapshots['DBSnapshots'][0]
 
 
-def get_oldest_manual_recrypted_rds_snapshots(rds_client, db_id):
-    print("Getting oldest recrypted (manual) snapshot from rds instance {}...".format(db_id))
-    # we can't query for the latest snapshot straight away, so we have to retrieve
-    # a full list and go through all of them
-    snapshots = rds_client.describe_db_snapshots(
-        DBInstanceIdentifier=db_id,
-        SnapshotType='manual'
-    )
-
-    oldest = 0
-    for snapshot in snapshots['DBSnapshots']:
-        if not "recrypted" in snapshot['DBSnapshotIdentifier']:
-            continue
-        if oldest == 0:
-            oldest = snapshot
-        if snapshot['SnapshotCreateTime'] < oldest['SnapshotCreateTime']:
-            oldest = snapshot
-
-    print("  Found snapshot {}".format(oldest['DBSnapshotIdentifier']))
-    return oldest
-
-
-def get_owned_rds_snapshots_count(rds_client, db_id):
-    print("Getting oldest (manual) snapshot from rds instance {}...".format(db_id))
+def get_owned_rds_snapshots(rds_client, db_id):
+    logger.info("Getting owned (manual) snapshots from rds instance %s...", db_id)
     # we can't query for the oldest snapshot straight away, so we have to retrieve
     # a full list and go through all of them
-    snapshots = rds_client.describe_db_snapshots(
+    snapshots = paginate_api_call(
+        rds_client, 'describe_db_snapshots', 'DBSnapshots',
         DBInstanceIdentifier=db_id,
         SnapshotType='manual',
         IncludeShared=False
     )
 
-    owned_rds_snapshots_count = 0
-    for snapshot in snapshots['DBSnapshots']:
-        if not "recrypted-copy" in snapshot['DBSnapshotIdentifier']:
-            continue
-        owned_rds_snapshots_count += 1
-    print("  Found {} owned snapshot(s) for DB instance {}".format(owned_rds_snapshots_count, db_id))
-    return owned_rds_snapshots_count
+    owned_rds_snapshots = [snapshot for snapshot in snapshots['DBSnapshots']
+                           if "recrypted-copy" in snapshot['DBSnapshotIdentifier']]
+    # oldest first
+    owned_rds_snapshots.sort(key=itemgetter('SnapshotCreateTime'))
+    logger.info("  Found %s owned snapshot(s) for DB instance %s", len(owned_rds_snapshots), db_id)
+    return owned_rds_snapshots
 
 
 if __name__ == '__main__':
@@ -306,14 +306,14 @@ def paginate_api_call(client, api_call, objecttype, *args, **kwargs):
     response = {}
     response[objecttype] = []
 
-    # Create a paginator
-    paginator = client.get_paginator(api_call)
-
-    # Create a PageIterator from the Paginator
-    page_iterator = paginator.paginate(**kwargs)
-    for page in page_iterator:
-        for item in page[objecttype]:
-            response[objecttype].append(item)
+    # Follow the RDS Marker directly instead of building a Paginator, most calls fit in a single page
+    operation = getattr(client, api_call)
+    while True:
+        page = operation(**kwargs)
+        response[objecttype].extend(page[objecttype])
+        if not page.get('Marker'):
+            break
+        kwargs['Marker'] = page['Marker']
 
     return response
 
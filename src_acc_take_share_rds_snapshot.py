@@ -5,9 +5,12 @@ import logging
 import os
 import re
 import sys
-import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from operator import itemgetter
 
 import boto3
+from botocore.config import Config
+from botocore.exceptions import WaiterError
 
 if "AWS_DEFAULT_REGION" not in os.environ:
     print("Please set the environment variable AWS_DEFAULT_REGION")
@@ -24,29 +27,45 @@ BACKUP_INTERVAL = int(os.getenv('INTERVAL', '24'))
 PATTERN = os.getenv('PATTERN', 'ALL_INSTANCES')
 TAGGEDINSTANCE = os.getenv('TAGGEDINSTANCE', 'FALSE')
 EXPECTED_SNAPSHOT_COUNT = int(os.getenv('EXPECTED_SNAPSHOT_COUNT', 4))
+MAX_WORKERS = int(os.getenv('MAX_WORKERS', 16))
+# poll snapshot status every WAIT_DELAY seconds, give up after WAIT_MAX_ATTEMPTS polls,
+# defaults allow up to 12 hours for large cross-KMS copies
+WAIT_DELAY = int(os.getenv('WAIT_DELAY', 15))
+WAIT_MAX_ATTEMPTS = int(os.getenv('WAIT_MAX_ATTEMPTS', 2880))
+KMS_KEY_RE = re.compile(r"^arn:aws:kms:(.+):\d{12}:(?:key\/[a-f0-9-]+)$")
+ACCOUNT_RE = re.compile(r"^\d{12}$")
 
 TIMESTAMP_FORMAT = '%Y-%m-%d-%H-%M'
 
-logger = logging.getLogger()
+# log to stdout alongside the print() output, the root logger is left alone so
+# botocore/urllib3 debug records (request headers, credentials) are never emitted
+logger = logging.getLogger(__name__)
 logger.setLevel(LOGLEVEL.upper())
-
-sns_client = boto3.client('sns')
+logger.propagate = False
+_log_handler = logging.StreamHandler(sys.stdout)
+_log_handler.setFormatter(logging.Formatter('%(message)s'))
+logger.addHandler(_log_handler)
+
+# one session for all clients, so service models and credentials are loaded only once
+session = boto3.session.Session(region_name=os.getenv('AWS_DEFAULT_REGION'))
+sns_client = session.client('sns')
 topic_arn = os.environ.get("TOPIC_ARN", "")
 
 
 def main():
 
-    aws_region = os.getenv('AWS_DEFAULT_REGION')
-    client = boto3.client('rds', region_name=aws_region)
+    # low-level clients are thread safe, the worker threads share this one,
+    # so size its connection pool to the number of workers
+    client = session.client('rds', config=Config(max_pool_connections=MAX_WORKERS))
 
     target_aws_account = os.getenv('TARGET_ACCOUNT', '0')
-    if not bool(re.match(r"^\d{12}$", target_aws_account)):
+    if not bool(ACCOUNT_RE.match(target_aws_account)):
         print("TARGET_ACCOUNT environment variable must be set to target AWS account id")
         sys.exit(1)
 
     # lookup KMS key ARN in env vars, it must be created in backup account and shared with main account
     kms_key_arn = os.getenv('KMS_KEY_ARN', '')
-    if not bool(re.match(r"^arn:aws:kms:(.+):\d{12}:(?:key\/[a-f0-9-]+)$", kms_key_arn)):
+    if not bool(KMS_KEY_RE.match(kms_key_arn)):
         print("KMS_KEY_ARN environment variable must be set to KMS key AWS arn, like arn:aws:kms:<region>:<account_id>:key/<key_id>")
         sys.exit(1)
 
@@ -59,21 +78,18 @@ def main():
         print("DB instances list for sharing is empty, matching pattern env var: PATTERN={}".format(PATTERN))
 
     ready_snapshot_count = 0
-    for db_instance in filtered_instances:
-        snapshot = get_latest_automatic_rds_snapshots(client, db_instance['DBInstanceIdentifier'])
-        # no snapshots found
-        if len(snapshot) == 0:
-            continue
-        recrypted_copy = recrypt_snapshot_with_new_key(client, snapshot, kms_key_arn)
-        wait_for_snapshot_to_be_ready(client, recrypted_copy)
-        share_snapshot_with_external_account(client, recrypted_copy, target_aws_account)
-        ready_snapshot_count += 1
-        # clean up old snapshots recrypted with key from backup account
-        while get_manual_recrypted_rds_snapshots_count(client, db_instance['DBInstanceIdentifier']) > 2:
-            snapshot = get_oldest_manual_recrypted_rds_snapshots(client, db_instance['DBInstanceIdentifier'])
-            print("Deleting oldest recrypted manual snapshot {}".format(snapshot['DBSnapshotIdentifier']))
-            client.delete_db_snapshot(DBSnapshotIdentifier=snapshot['DBSnapshotIdentifier'])
-            time.sleep(1)
+    if len(filtered_instances) > 0:
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(filtered_instances))) as executor:
+            futures = {executor.submit(process_instance, client, db_instance, kms_key_arn, target_aws_account):
+                       db_instance for db_instance in filtered_instances}
+            for future in as_completed(futures):
+                # a failed instance is not counted, so the count check below reports it
+                try:
+                    if future.result():
+                        ready_snapshot_count += 1
+                except Exception:
+                    logger.exception("Sharing snapshot of DB instance %s failed",
+                                     futures[future]['DBInstanceIdentifier'])
     if ready_snapshot_count != EXPECTED_SNAPSHOT_COUNT:
         sns_message = ("COPY_RDS_SNAPSHOT_COUNT_ERROR sharing RDS snapshots completed with error: "
                        "Expected snapshot count={0} not equal to actual snapshot count={1}, exiting"
@@ -87,34 +103,48 @@ def main():
     return
 
 
+def process_instance(client, db_instance, kms_key_arn, target_aws_account):
+    # recrypt, share and clean up snapshots of a single DB instance, returns True if a snapshot was shared
+    snapshot = get_latest_automatic_rds_snapshots(client, db_instance['DBInstanceIdentifier'])
+    # no snapshots found
+    if snapshot is None:
+        return False
+    recrypted_copy = recrypt_snapshot_with_new_key(client, snapshot, kms_key_arn)
+    try:
+        wait_for_snapshot_to_be_ready(client, recrypted_copy)
+    except WaiterError as e:
+        logger.error("Snapshot %s did not become available: %s", recrypted_copy['DBSnapshotIdentifier'], e)
+        return False
+    share_snapshot_with_external_account(client, recrypted_copy, target_aws_account)
+    # clean up old snapshots recrypted with key from backup account
+    # keep the two newest snapshots, the list is sorted oldest first
+    for snapshot in get_manual_recrypted_rds_snapshots(client, db_instance['DBInstanceIdentifier'])[:-2]:
+        logger.info("Deleting oldest recrypted manual snapshot %s", snapshot['DBSnapshotIdentifier'])
+        client.delete_db_snapshot(DBSnapshotIdentifier=snapshot['DBSnapshotIdentifier'])
+    return True
+
+
 def share_snapshot_with_external_account(rds_client, snapshot, target_account):
     # in order to restore a snapshot from another account it needs to be shared
     # with that account first
-    print("Modifying snapshot {} to be shared with account {}...".format(snapshot['DBSnapshotArn'], target_account))
+    logger.info("Modifying snapshot %s to be shared with account %s...", snapshot['DBSnapshotArn'], target_account)
     rds_client.modify_db_snapshot_attribute(
         DBSnapshotIdentifier=snapshot['DBSnapshotIdentifier'],
         AttributeName='restore',
         ValuesToAdd=[target_account]
     )
-    print("  Modified snapshot {}".format(snapshot['DBSnapshotIdentifier']))
+    logger.info("  Modified snapshot %s", snapshot['DBSnapshotIdentifier'])
 
 
 def wait_for_snapshot_to_be_ready(rds_client, snapshot):
-    # simply check if the specified snapshot is healthy every 10 seconds until it is available
-    percent_progress = -1
-    while True:
-        snapshotcheck = rds_client.describe_db_snapshots(
-            DBSnapshotIdentifier=snapshot['DBSnapshotIdentifier'])['DBSnapshots'][0]
-        if snapshotcheck['Status'] == 'available':
-            print("  Snapshot {} complete and available!".format(snapshot['DBSnapshotIdentifier']))
-            break
-        else:
-            # output percentage only when it's changed
-            if percent_progress != snapshotcheck['PercentProgress']:
-                percent_progress = snapshotcheck['PercentProgress']
-                print("Snapshot {} in progress, {}% complete".format(
-                    snapshot['DBSnapshotIdentifier'], percent_progress))
-            time.sleep(10)
+    # let the boto3 waiter poll the specified snapshot until it is available
+    logger.info("Waiting for snapshot %s to become available...", snapshot['DBSnapshotIdentifier'])
+    waiter = rds_client.get_waiter('db_snapshot_available')
+    waiter.wait(
+        DBSnapshotIdentifier=snapshot['DBSnapshotIdentifier'],
+        WaiterConfig={'Delay': WAIT_DELAY, 'MaxAttempts': WAIT_MAX_ATTEMPTS}
+    )
+    logger.info("  Snapshot %s complete and available!", snapshot['DBSnapshotIdentifier'])
 
 
 def recrypt_snapshot_with_new_key(rds_client, snapshot, kms_key_arn):
@@ -124,7 +154,7 @@ def recrypt_snapshot_with_new_key(rds_client, snapshot, kms_key_arn):
     else:
         target_db_snapshot_id = "{}-recrypted".format(snapshot['DBSnapshotIdentifier'])
 
-    print("Copying automatic snapshot {} to manual snapshot".format(snapshot['DBSnapshotIdentifier']))
+    logger.info("Copying automatic snapshot %s to manual snapshot", snapshot['DBSnapshotIdentifier'])
 
     try:
         # copy the snapshot, supplying the new KMS key (which is also shared with
@@ -134,11 +164,11 @@ def recrypt_snapshot_with_new_key(rds_client, snapshot, kms_key_arn):
             TargetDBSnapshotIdentifier=target_db_snapshot_id,
             KmsKeyId=kms_key_arn
         )
-        print("  Snapshot {} created".format(snapshot['DBSnapshotIdentifier']))
+        logger.info("  Snapshot %s created", snapshot['DBSnapshotIdentifier'])
         return copy['DBSnapshot']
     except rds_client.exceptions.DBSnapshotAlreadyExistsFault:
         # if the snapshot we tried to make already exists, retrieve it
-        print("Snapshot already exists, retrieving {}".format(target_db_snapshot_id))
+        logger.info("Snapshot already exists, retrieving %s", target_db_snapshot_id)
 
         snapshots = rds_client.describe_db_snapshots(DBSnapshotIdentifier=target_db_snapshot_id)
 
@@ -146,67 +176,41 @@ def recrypt_snapshot_with_new_key(rds_client, snapshot, kms_key_arn):
 
 
 def get_latest_automatic_rds_snapshots(rds_client, db_id):
-    print("Getting latest (automated) snapshot from rds instance {}...".format(db_id))
+    logger.info("Getting latest (automated) snapshot from rds instance %s...", db_id)
     # we can't query for the latest snapshot straight away, so we have to retrieve
     # a full list and go through all of them
-    snapshots = rds_client.describe_db_snapshots(
+    snapshots = paginate_api_call(
+        rds_client, 'describe_db_snapshots', 'DBSnapshots',
         DBInstanceIdentifier=db_id,
         SnapshotType='automated'
     )
-    latest = []
-    for snapshot in snapshots['DBSnapshots']:
-        if len(latest) == 0:
-            latest = snapshot
-        if not snapshot.get('SnapshotCreateTime') or not latest.get('SnapshotCreateTime'):
-            continue
-        if snapshot['SnapshotCreateTime'] > latest['SnapshotCreateTime']:
-            latest = snapshot
+    # snapshots which are still being created have no SnapshotCreateTime yet
+    latest = max((snapshot for snapshot in snapshots['DBSnapshots'] if snapshot.get('SnapshotCreateTime')),
+                 key=itemgetter('SnapshotCreateTime'), default=None)
     # if we have any snapshots at all
-    if len(latest) > 0:
-        print("  Found snapshot {}".format(latest['DBSnapshotIdentifier']))
+    if latest is not None:
+        logger.info("  Found snapshot %s", latest['DBSnapshotIdentifier'])
     else:
-        print("  No snapshots found for instance {}".format(db_id))
+        logger.info("  No snapshots found for instance %s", db_id)
     return latest
 
 
-def get_oldest_manual_recrypted_rds_snapshots(rds_client, db_id):
-    print("Getting oldest recrypted (manual) snapshot from rds instance {}...".format(db_id))
-    # we can't query for the latest snapshot straight away, so we have to retrieve
-    # a full list and go through all of them
-    snapshots = rds_client.describe_db_snapshots(
-        DBInstanceIdentifier=db_id,
-        SnapshotType='manual'
-    )
-
-    oldest = 0
-    for snapshot in snapshots['DBSnapshots']:
-        if not "recrypted" in snapshot['DBSnapshotIdentifier']:
-            continue
-        if oldest == 0:
-            oldest = snapshot
-        if snapshot['SnapshotCreateTime'] < oldest['SnapshotCreateTime']:
-            oldest = snapshot
-
-    print("  Found snapshot {}".format(oldest['DBSnapshotIdentifier']))
-    return oldest
-
-
-def get_manual_recrypted_rds_snapshots_count(rds_client, db_id):
-    print("Getting oldest recrypted (manual) snapshot from rds instance {}...".format(db_id))
+def get_manual_recrypted_rds_snapshots(rds_client, db_id):
+    logger.info("Getting recrypted (manual) snapshots from rds instance %s...", db_id)
     # we can't query for the oldest snapshot straight away, so we have to retrieve
     # a full list and go through all of them
-    snapshots = rds_client.describe_db_snapshots(
+    snapshots = paginate_api_call(
+        rds_client, 'describe_db_snapshots', 'DBSnapshots',
         DBInstanceIdentifier=db_id,
         SnapshotType='manual'
     )
 
-    recrypted_snapshots_count = 0
-    for snapshot in snapshots['DBSnapshots']:
-        if not "recrypted" in snapshot['DBSnapshotIdentifier']:
-            continue
-        recrypted_snapshots_count += 1
-    print("  Found {} manual recrypted snapshot(s) for DB instance {}".format(recrypted_snapshots_count, db_id))
-    return recrypted_snapshots_count
+    recrypted_snapshots = [snapshot for snapshot in snapshots['DBSnapshots']
+                           if "recrypted" in snapshot['DBSnapshotIdentifier']]
+    # oldest first
+    recrypted_snapshots.sort(key=itemgetter('SnapshotCreateTime'))
+    logger.info("  Found %s manual recrypted snapshot(s) for DB instance %s", len(recrypted_snapshots), db_id)
+    return recrypted_snapshots
 
 
 if __name__ == '__main__':